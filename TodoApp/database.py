@@ -1,8 +1,11 @@
+import os
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-SQLALCHEMY_DB_URL = "sqlite:///./todos.db"
+# next to this file, wherever the app is started from
+SQLALCHEMY_DB_URL = "sqlite:///" + os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "todos.db")
 
 engine = create_engine(SQLALCHEMY_DB_URL,
                        connect_args={"check_same_thread": False}
@@ -1,14 +1,43 @@
+# run from the repository root as `uvicorn TodoApp.main:app`, or from
+# TodoApp/ as `uvicorn main:app`
+import os
+import sys
 from fastapi import FastAPI, Depends, HTTPException
-import models
-from database import engine, SessionLocal
+if __package__:
+    from . import models
+    from .database import engine, SessionLocal
+else:
+    # the helpers shared with books.py are one directory up
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+    import models
+    from database import engine, SessionLocal
+from metrics import MetricsMiddleware, metrics_response, record
+from profiler import router as profile_router
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import Optional
+import time
 
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+app.include_router(profile_router)
 models.Base.metadata.create_all(bind=engine)
 
 
+@event.listens_for(engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    record('db', time.perf_counter() - conn.info['query_start'].pop())
+
+
 def get_db():
     try:
         db = SessionLocal()
@@ -30,6 +59,11 @@ async def read_all(db: Session = Depends(get_db)):
     return db.query(models.Todos).all()
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics_response()
+
+
 @app.get("/todo/{todo_id}")
 async def get_todo_by_id(todo_id: int, db: Session = Depends(get_db)):
     todo_model = db.query(models.Todos) \
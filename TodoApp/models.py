@@ -1,5 +1,8 @@
 from sqlalchemy import Boolean, Column, Integer, String
-from database import Base
+if __package__:
+    from .database import Base
+else:
+    from database import Base
 
 
 class Todos(Base):
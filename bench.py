@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from catalog import encode_cursor
+from loader import iter_records
+from wal import write_catalog
+
+ENDPOINTS = ('list', 'get', 'insert')
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def synthesize(source, target, scale):
+    # Write `scale` copies of the catalog in `source`; every copy after the
+    # first gets a suffix on its ISBNs so they stay unique. -> list of ISBNs
+    isbns = []
+
+    def records():
+        for copy in range(scale):
+            for record in iter_records(source):
+                record = dict(record)
+                if record.get('isbn') and copy:
+                    record['isbn'] = f"{record['isbn']}-{copy}"
+                if record.get('isbn'):
+                    isbns.append(record['isbn'])
+                yield record
+
+    write_catalog(target, records())
+    return isbns
+
+
+def percentile(ordered, p):
+    # nearest-rank percentile of an already sorted list
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def summarize(latencies, errors, seconds):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput': round(len(ordered) / seconds, 1) if seconds else None,
+        'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': ms(percentile(ordered, 50)),
+        'p95_ms': ms(percentile(ordered, 95)),
+        'p99_ms': ms(percentile(ordered, 99)),
+    }
+
+
+class Workload:
+    # Builds requests for each endpoint. Reads pick random books so most of
+    # them miss the response cache; inserts use fresh ISBNs so none conflict.
+    def __init__(self, isbns, seed=0):
+        self.isbns = isbns
+        self.random = random.Random(seed)
+        self.inserted = itertools.count()
+        self.run = f'{os.getpid()}-{int(time.time())}'
+
+    def request(self, endpoint):
+        if endpoint == 'list':
+            row = self.random.randrange(len(self.isbns))
+            cursor = encode_cursor((self.isbns[row], row))
+            return 'GET', '/books', {'params': {'limit': 20,
+                                                'cursor': cursor}}
+        if endpoint == 'get':
+            return 'GET', f'/books/{self.random.choice(self.isbns)}', {}
+        n = next(self.inserted)
+        return 'POST', '/books', {'json': {
+            'title': f'Benchmark book {n}',
+            'isbn': f'bench-{self.run}-{n}',
+            'pageCount': 100 + n % 500,
+            'thumbnailUrl': '',
+            'status': 'PUBLISH',
+            'authors': ['Benchmark Author'],
+            'categories': ['Benchmarks'],
+        }}
+
+
+async def drive(client, workload, endpoint, requests, concurrency):
+    latencies, errors = [], 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, kwargs = workload.request(endpoint)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            if failed:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+async def run_endpoints(client, workload, args):
+    results = {}
+    for endpoint in args.endpoints:
+        if args.warmup:
+            await drive(client, workload, endpoint, args.warmup,
+                        args.concurrency)
+        results[endpoint] = await drive(client, workload, endpoint,
+                                        args.requests, args.concurrency)
+        print(f"  {endpoint:6} {format_result(results[endpoint])}")
+    return results
+
+
+async def bench_in_process(workdir, workload, args):
+    # books.py picks its catalog file when it is imported, so import a fresh
+    # copy for every synthesized catalog
+    os.environ['BOOKS_JSON'] = os.path.join(workdir, 'books.json')
+    sys.modules.pop('books', None)
+    books = importlib.import_module('books')
+    try:
+        async with books.lifespan(books.app):
+            await asyncio.to_thread(books.watcher.ready.wait)
+            transport = httpx.ASGITransport(app=books.app)
+            async with httpx.AsyncClient(transport=transport,
+                                         base_url='http://bench') as client:
+                return await run_endpoints(client, workload, args)
+    finally:
+        books.wal.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def bench_live(workdir, workload, args):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=HERE,
+               BOOKS_JSON=os.path.join(workdir, 'books.json'))
+    command = [sys.executable, '-m', 'uvicorn', 'books:app',
+               '--host', '127.0.0.1', '--port', str(port),
+               '--log-level', 'warning', '--no-access-log']
+    if args.workers > 1:
+        command += ['--workers', str(args.workers)]
+    server = subprocess.Popen(command, env=env)
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}',
+                                     limits=limits, timeout=60) as client:
+            await wait_ready(client, server, args.startup_timeout)
+            return await run_endpoints(client, workload, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def wait_ready(client, server, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with {server.returncode}")
+        try:
+            if (await client.get('/ready')).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"server not ready after {timeout}s")
+
+
+def format_result(result):
+    return (f"{result['throughput'] or 0:>9.1f} req/s  "
+            f"p50 {result['p50_ms'] or 0:>8.3f} ms  "
+            f"p95 {result['p95_ms'] or 0:>8.3f} ms  "
+            f"p99 {result['p99_ms'] or 0:>8.3f} ms  "
+            f"errors {result['errors']}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    # print throughput and p99 changes for every run present in both files
+    before = {(run['mode'], run['scale'], endpoint): result
+              for run in previous['runs']
+              for endpoint, result in run['endpoints'].items()}
+    print(f"\nCompared with {previous.get('commit')}:")
+    for run in current['runs']:
+        for endpoint, result in run['endpoints'].items():
+            old = before.get((run['mode'], run['scale'], endpoint))
+            if not old or not old['throughput'] or not old['p99_ms']:
+                continue
+            throughput = result['throughput'] / old['throughput'] - 1
+            p99 = result['p99_ms'] / old['p99_ms'] - 1
+            print(f"  {run['mode']:10} {run['scale']:>5}x {endpoint:6} "
+                  f"throughput {throughput:+.1%}  p99 {p99:+.1%}")
+
+
+async def main(args):
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'workers': args.workers,
+        'runs': [],
+    }
+    for scale in args.scale:
+        workdir = tempfile.mkdtemp(prefix=f'books-bench-{scale}x-')
+        try:
+            source = os.path.join(workdir, 'books.json')
+            isbns = synthesize(args.source, source, scale)
+            print(f"{scale}x: {len(isbns)} books in {workdir}")
+            for mode in args.mode:
+                print(f" {mode}")
+                # a directory per mode, so one doesn't start from the
+                # books.wal and books.bin another left behind
+                modedir = os.path.join(workdir, mode)
+                os.mkdir(modedir)
+                shutil.copy(source, modedir)
+                workload = Workload(isbns, args.seed)
+                bench = bench_in_process if mode == 'in-process' \
+                    else bench_live
+                results['runs'].append({
+                    'mode': mode,
+                    'scale': scale,
+                    'books': len(isbns),
+                    'endpoints': await bench(modedir, workload, args),
+                })
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+    print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test the books API against catalogs synthesized "
+                    "from books.json at several sizes.")
+    parser.add_argument('--source', default=os.path.join(HERE, 'books.json'))
+    parser.add_argument('--scale', type=int, nargs='+',
+                        default=[1, 10, 100, 1000])
+    parser.add_argument('--mode', nargs='+', choices=('in-process', 'live'),
+                        default=['in-process', 'live'])
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS,
+                        default=list(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="requests per endpoint")
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="uvicorn workers in live mode")
+    parser.add_argument('--startup-timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--compare', help="earlier results file to diff "
+                                          "against")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,362 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+
+import numpy as np
+
+from bookrecord import BookRecord, as_record
+from catalog import FieldIndex, RangeIndex, Segment
+from loader import iter_records
+from schemas import BOOK_FIELDS, parse_date
+from search import SearchIndex, TrigramIndex
+
+# File layout, all little endian and every section 8-byte aligned:
+#
+#   header     magic, format version, row count, section count
+#   directory  (offset, length) of every section
+#   manifest   the first section, utf-8 JSON naming every other section
+#              and its dtype, describing the catalog segment built over
+#              the rows and identifying the JSON they were converted from
+#   sections   the record columns in SECTIONS order: fixed-width columns,
+#              then an offset table and a utf-8 blob for each string
+#              column, then item offsets plus an offset table and blob for
+#              each list-of-strings column; then the arrays and sorted
+#              string tables of the segment's indexes
+MAGIC = b'BOOKCAT1'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIQI')
+ENTRY = struct.Struct('<QQ')
+
+STRING_FIELDS = ('title', 'isbn', 'thumbnailUrl', 'shortDescription',
+                 'longDescription', 'status')
+LIST_FIELDS = ('authors', 'categories')
+# bit per field in the presence column, so missing keys stay missing
+PRESENCE_BITS = {field: 1 << n for n, field in enumerate(BOOK_FIELDS)}
+
+SECTIONS = (
+    ('presence', '<u2'),
+    ('pageCount', '<i4'),
+    ('publishedDate', '<i8'),
+    ('publishedOffset', '<i2'),
+) + tuple(
+    section for field in STRING_FIELDS
+    for section in ((field + '.offsets', '<u8'), (field + '.data', 'u1'))
+) + tuple(
+    section for field in LIST_FIELDS
+    for section in ((field + '.items', '<u8'), (field + '.offsets', '<u8'),
+                    (field + '.data', 'u1'))
+)
+
+# classes a manifest may rebuild
+INDEX_CLASSES = {cls.__name__: cls for cls in (
+    Segment, FieldIndex, RangeIndex, SearchIndex, TrigramIndex)}
+
+
+class _Strings:
+    def __init__(self):
+        self.offsets = array('Q', [0])
+        self.data = tempfile.SpooledTemporaryFile(max_size=64 << 20)
+
+    def append(self, value):
+        self.offsets.append(self.offsets[-1] + self.data.write(value.encode()))
+
+
+def file_hash(f):
+    # hash of everything in the open binary file `f`, read from the start
+    digest = hashlib.blake2b(digest_size=16)
+    f.seek(0)
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()
+
+
+def source_key(f, hashed=True):
+    # Identifies the file open as `f` from its handle, so the key describes
+    # the bytes read through that handle even if the path is replaced
+    # while they are converted. Renames keep it, so a compacted copy
+    # matches once moved into place.
+    stat = os.fstat(f.fileno())
+    key = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if hashed:
+        key['hash'] = file_hash(f)
+    return key
+
+
+def converted_from(binary, source):
+    # -> whether `binary` is a current-format conversion of the file open
+    # as `source`. Size and mtime are enough on the common path; if only
+    # the mtime moved (a copy or a touch) the content hash decides.
+    try:
+        catalog = BinaryCatalog(binary)
+    except (OSError, ValueError, KeyError, struct.error):
+        return False
+    saved = catalog.manifest.get('source')
+    catalog.close()
+    key = source_key(source, hashed=False)
+    if saved is None or saved['size'] != key['size']:
+        return False
+    return (saved['mtime'] == key['mtime']
+            or saved['hash'] == file_hash(source))
+
+
+def convert(source, target, progress=None):
+    # source: a path or an open binary file
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return convert(f, target, progress)
+    key = source_key(source)
+    presence = array('H')
+    page_counts = array('i')
+    published = array('q')
+    published_offsets = array('h')
+    strings = {field: _Strings() for field in STRING_FIELDS}
+    lists = {field: (array('Q', [0]), _Strings()) for field in LIST_FIELDS}
+    records = []
+
+    for record in iter_records(source, progress=progress):
+        records.append(as_record(record))
+        bits = 0
+        for field in BOOK_FIELDS:
+            if field in record:
+                bits |= PRESENCE_BITS[field]
+        presence.append(bits)
+        page_counts.append(record.get('pageCount') or 0)
+        millis, offset = parse_date(record.get('publishedDate')) or (0, 0)
+        published.append(millis)
+        published_offsets.append(offset)
+        for field in STRING_FIELDS:
+            strings[field].append(record.get(field) or '')
+        for field in LIST_FIELDS:
+            items, values = lists[field]
+            for value in record.get(field) or ():
+                values.append(value)
+            items.append(len(values.offsets) - 1)
+
+    columns = {
+        'presence': presence,
+        'pageCount': page_counts,
+        'publishedDate': published,
+        'publishedOffset': published_offsets,
+    }
+    for field, column in strings.items():
+        columns[field + '.offsets'] = column.offsets
+        columns[field + '.data'] = column.data
+    for field, (items, column) in lists.items():
+        columns[field + '.items'] = items
+        columns[field + '.offsets'] = column.offsets
+        columns[field + '.data'] = column.data
+    # name -> (dtype, array or file)
+    sections = {name: (dtype, columns[name]) for name, dtype in SECTIONS}
+    segment = _flatten(Segment(0, records), 'segment', sections)
+    manifest = json.dumps({
+        'sections': [[name, dtype] for name, (dtype, _) in sections.items()],
+        'segment': segment,
+        'source': key,
+    }).encode()
+    sections = [manifest] + [data for _, data in sections.values()]
+
+    directory = []
+    position = _align(HEADER.size + ENTRY.size * len(sections))
+    for section in sections:
+        length = _length(section)
+        directory.append((position, length))
+        position = _align(position + length)
+
+    tmp = f'{target}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(presence),
+                            len(sections)))
+        for entry in directory:
+            f.write(ENTRY.pack(*entry))
+        for section, (offset, _) in zip(sections, directory):
+            f.write(b'\0' * (offset - f.tell()))
+            if isinstance(section, bytes):
+                f.write(section)
+            elif isinstance(section, (array, np.ndarray)):
+                section.tofile(f)
+            else:
+                section.seek(0)
+                shutil.copyfileobj(section, f)
+                section.close()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, target)
+    return len(presence)
+
+
+def _flatten(value, name, sections):
+    # -> JSON description of an index value; its arrays and lists of
+    # strings go into `sections` under names starting with `name`
+    if isinstance(value, np.ndarray):
+        sections[name] = (value.dtype.str, value)
+        return {'array': name}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, list):
+        if value and all(isinstance(item, int) for item in value):
+            sections[name] = ('<i8', np.array(value, dtype='<i8'))
+            return {'ints': name}
+        column = _Strings()
+        for item in value:
+            column.append(item)
+        sections[name + '.offsets'] = ('<u8', column.offsets)
+        sections[name + '.data'] = ('u1', column.data)
+        return {'strings': name}
+    if isinstance(value, dict):
+        return {'dict': {key: _flatten(item, f'{name}.{key}', sections)
+                         for key, item in value.items()}}
+    if value is None or isinstance(value, (int, float, str)):
+        return {'value': value}
+    # records live in the columns above, not in the index, and private
+    # attributes are caches rebuilt on first use
+    return {'object': type(value).__name__,
+            'attrs': {key: _flatten(item, f'{name}.{key}', sections)
+                      for key, item in vars(value).items()
+                      if key != 'records' and not key.startswith('_')}}
+
+
+def _align(position):
+    return (position + 7) & ~7
+
+
+def _length(section):
+    if isinstance(section, bytes):
+        return len(section)
+    if isinstance(section, array):
+        return len(section) * section.itemsize
+    if isinstance(section, np.ndarray):
+        return section.nbytes
+    return section.tell()
+
+
+class StringColumn:
+    # Sorted strings of an index, decoded from the mapping on access; bisect
+    # works on it like on a list
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        if not 0 <= n < len(self.offsets) - 1:
+            raise IndexError(n)
+        start, end = self.offsets[n], self.offsets[n + 1]
+        return self.data[start:end].tobytes().decode()
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+class BinaryCatalog:
+    # Read-only view of a converted catalog. Records are decoded from the
+    # mapping on access and segment() maps the indexes stored with them, so
+    # loading decodes nothing, the process only holds the pages it touches
+    # and every worker mapping the same file shares one page-cache copy.
+    # `source` is a path or an already open binary file.
+    def __init__(self, source):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            path = source
+        else:
+            self.mm = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            path = source.name
+        self.path = path
+        magic, version, rows, count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a version {FORMAT_VERSION} '
+                             f'binary catalog')
+        directory = [ENTRY.unpack_from(self.mm, HEADER.size + n * ENTRY.size)
+                     for n in range(count)]
+        offset, length = directory[0]
+        self.manifest = json.loads(self.mm[offset:offset + length])
+        if len(self.manifest['sections']) != count - 1:
+            raise ValueError(f'{path} has {count - 1} sections, its manifest '
+                             f'names {len(self.manifest["sections"])}')
+        self.rows = rows
+        self.columns = {}
+        for (name, dtype), (offset, length) in zip(
+                self.manifest['sections'], directory[1:]):
+            itemsize = np.dtype(dtype).itemsize
+            self.columns[name] = np.frombuffer(
+                self.mm, dtype=dtype, count=length // itemsize, offset=offset)
+
+    def __len__(self):
+        return self.rows
+
+    def segment(self):
+        # -> the catalog Segment over these rows, its arrays mapped from
+        # the file
+        segment = self._restore(self.manifest['segment'])
+        segment.records = self
+        return segment
+
+    def _restore(self, spec):
+        if 'array' in spec:
+            return self.columns[spec['array']]
+        if 'ints' in spec:
+            return self.columns[spec['ints']].tolist()
+        if 'strings' in spec:
+            name = spec['strings']
+            return StringColumn(self.columns[name + '.offsets'],
+                                self.columns[name + '.data'])
+        if 'dict' in spec:
+            return {key: self._restore(item)
+                    for key, item in spec['dict'].items()}
+        if 'value' in spec:
+            return spec['value']
+        index = INDEX_CLASSES[spec['object']].__new__(
+            INDEX_CLASSES[spec['object']])
+        index.__dict__.update({key: self._restore(item)
+                               for key, item in spec['attrs'].items()})
+        return index
+
+    def __getitem__(self, row):
+        if not 0 <= row < self.rows:
+            raise IndexError(row)
+        bits = int(self.columns['presence'][row])
+        values = {}
+        for field in BOOK_FIELDS:
+            if field != 'publishedDate' and bits & PRESENCE_BITS[field]:
+                values[field] = self._value(field, row)
+        if bits & PRESENCE_BITS['publishedDate']:
+            values['published'] = int(self.columns['publishedDate'][row])
+            values['publishedOffset'] = int(
+                self.columns['publishedOffset'][row])
+        # the mapping already keeps descriptions out of memory
+        return BookRecord(**values, compress=False)
+
+    def _value(self, field, row):
+        if field == 'pageCount':
+            return int(self.columns['pageCount'][row])
+        if field in LIST_FIELDS:
+            items = self.columns[field + '.items']
+            return [self._string(field, item)
+                    for item in range(items[row], items[row + 1])]
+        return self._string(field, row)
+
+    def _string(self, field, n):
+        offsets = self.columns[field + '.offsets']
+        data = self.columns[field + '.data']
+        return data[offsets[n]:offsets[n + 1]].tobytes().decode()
+
+    def close(self):
+        self.columns.clear()
+        self.mm.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python bincatalog.py books.json books.bin")
+    rows = convert(sys.argv[1], sys.argv[2])
+    print(f"Wrote {rows} books to {sys.argv[2]}")
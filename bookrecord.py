@@ -0,0 +1,113 @@
+import sys
+import zlib
+
+from schemas import BOOK_FIELDS, parse_date, format_date
+
+# shorter descriptions cost less as plain text than compressed
+COMPRESS_MIN = 128
+
+
+class BookRecord:
+    # In-memory form of one catalog entry. Repeated strings (status,
+    # authors, categories) are interned, publishedDate is kept as epoch
+    # milliseconds plus its UTC offset, and descriptions are stored
+    # compressed until something asks for them. Attributes are named after
+    # the books.json keys and are None where the key was missing;
+    # to_dict() rebuilds the JSON shape at the response edge.
+    __slots__ = ('title', 'isbn', 'pageCount', 'published', 'publishedOffset',
+                 'thumbnailUrl', 'status', 'authors', 'categories',
+                 '_short', '_long')
+
+    def __init__(self, title=None, isbn=None, pageCount=None, published=None,
+                 publishedOffset=0, thumbnailUrl=None, shortDescription=None,
+                 longDescription=None, status=None, authors=None,
+                 categories=None, compress=True):
+        self.title = title
+        self.isbn = isbn
+        self.pageCount = pageCount
+        self.published = published
+        self.publishedOffset = publishedOffset
+        self.thumbnailUrl = thumbnailUrl
+        self.status = _intern(status)
+        self.authors = _intern_all(authors)
+        self.categories = _intern_all(categories)
+        if compress:
+            shortDescription = _pack(shortDescription)
+            longDescription = _pack(longDescription)
+        self._short = shortDescription
+        self._long = longDescription
+
+    @classmethod
+    def from_dict(cls, record):
+        published, offset = parse_date(record.get('publishedDate')) or (None, 0)
+        return cls(
+            title=record.get('title'),
+            isbn=record.get('isbn'),
+            pageCount=record.get('pageCount'),
+            published=published,
+            publishedOffset=offset,
+            thumbnailUrl=record.get('thumbnailUrl'),
+            shortDescription=record.get('shortDescription'),
+            longDescription=record.get('longDescription'),
+            status=record.get('status'),
+            authors=record.get('authors'),
+            categories=record.get('categories'),
+        )
+
+    @property
+    def publishedDate(self):
+        if self.published is None:
+            return None
+        return format_date(self.published, self.publishedOffset)
+
+    @property
+    def shortDescription(self):
+        return _unpack(self._short)
+
+    @property
+    def longDescription(self):
+        return _unpack(self._long)
+
+    def to_dict(self, fields=BOOK_FIELDS):
+        record = {}
+        for field in fields:
+            value = getattr(self, field)
+            if value is not None:
+                record[field] = list(value) if type(value) is tuple else value
+        return record
+
+    def __eq__(self, other):
+        if not isinstance(other, BookRecord):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'BookRecord(isbn={self.isbn!r}, title={self.title!r})'
+
+
+def as_record(record):
+    if isinstance(record, BookRecord):
+        return record
+    return BookRecord.from_dict(record)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _intern_all(values):
+    if values is None:
+        return None
+    return tuple(_intern(value) for value in values)
+
+
+def _pack(text):
+    if text is None or len(text) < COMPRESS_MIN:
+        return text
+    return zlib.compress(text.encode())
+
+
+def _unpack(value):
+    if type(value) is bytes:
+        return zlib.decompress(value).decode()
+    return value
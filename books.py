@@ -1,10 +1,193 @@
-from fastapi import FastAPI
-from schemas import read_data, get_book_by_isbn, Books
+from fastapi import (FastAPI, Depends, HTTPException, Header, Query,
+                     Request)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from schemas import (get_books_by_isbn, validate_lines, date_millis,
+                     Books, IsbnBatch, BOOK_FIELDS)
+from loader import iter_records
+from catalog import (Catalog, FILTER_FIELDS, encode_cursor, decode_cursor,
+                     normalize, project)
+from bincatalog import BinaryCatalog, convert, converted_from
+from dedupe import DuplicateFinder
+from metrics import MetricsMiddleware, metrics_response, timed
+from profiler import require_token, router as profile_router
+from search import normalize_query
+from similar import SimilarBooks
+from watcher import CatalogWatcher
+from wal import WriteAheadLog, Compactor, write_catalog
+from locks import file_lock
+from responses import (ResponseCache, cached_json, ndjson_chunks,
+                       gzip_chunks, accepts_gzip)
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import List, Optional
+import argparse
+import os
 import uvicorn
 
-app = FastAPI()
 
-data = read_data()
+def report_progress(count, done, total):
+    print(f"Loaded {count} books ({done * 100 // max(total, 1)}%)")
+
+
+# The catalog file, books.json unless BOOKS_JSON points elsewhere; its
+# books.bin and books.wal live next to it.
+CATALOG = os.environ.get('BOOKS_JSON', 'books.json')
+BINARY = os.path.splitext(CATALOG)[0] + '.bin'
+LOG = os.path.splitext(CATALOG)[0] + '.wal'
+
+
+def load_catalog(source=CATALOG, binary=BINARY):
+    # Every worker maps books.bin, which carries the indexes as well as the
+    # records, so they share one page-cache copy of both. When it is
+    # missing or was converted from another version of books.json, the
+    # first worker to get the lock converts it and the rest wait and map
+    # the result, so a changed books.json is parsed once, not per worker.
+    # The key, the check and the conversion all go through one handle of
+    # the JSON, so a file replaced mid-conversion isn't taken for its
+    # predecessor.
+    with open(source, 'rb') as f:
+        if not converted_from(binary, f):
+            with file_lock(binary + '.lock'):
+                if not converted_from(binary, f):
+                    try:
+                        rows = convert(f, binary, progress=report_progress)
+                    except OSError as e:
+                        # read-only directory, say: build in memory
+                        print(f"Could not write {binary}: {e}")
+                        return Catalog(iter_records(f,
+                                                    progress=report_progress))
+                    print(f"Wrote {rows} books to {binary}")
+    print(f"Mapping {binary}")
+    return Catalog(segments=[BinaryCatalog(binary).segment()])
+
+
+def load():
+    # -> (catalog with the log replayed, log position it was replayed to).
+    # Replaying here keeps it outside watcher.lock; catch_up only applies
+    # what was appended since.
+    catalog = load_catalog()
+    records, position = wal.read()
+    catalog, added = catalog.with_records(records)
+    if added:
+        print(f"Replayed {len(added)} books from {wal.path}")
+    return catalog, position
+
+
+def catch_up(loaded):
+    # under watcher.lock, so no insert lands in between
+    catalog, position = loaded
+    records, wal.followed = wal.read(position)
+    catalog, _ = catalog.with_records(records)
+    return catalog
+
+
+def follow_log(catalog):
+    # Picks up books other workers have inserted. Every worker runs it;
+    # one working alone only re-reads its own inserts, which are skipped.
+    records, wal.followed = wal.read(wal.followed)
+    catalog, _ = catalog.with_records(records)
+    return catalog
+
+
+def compact():
+    # Writes the catalog, log included, to a new books.json and books.bin,
+    # then swaps them in and trims the log. The swap only happens if the
+    # files are still the ones the live catalog was loaded from, so an
+    # edit made while compacting is picked up by the watcher, not lost.
+    with watcher.lock:
+        catalog = watcher.catalog
+        loaded = watcher.loaded
+        if catalog is None or watcher.stamp() != loaded:
+            return
+        # everything up to the position followed is now in the catalog
+        catalog = watcher.catalog = follow_log(catalog)
+        position = wal.followed
+        if position is None:
+            return
+    compacted = CATALOG + '.compact'
+    write_catalog(compacted, (record.to_dict() for record in catalog))
+    convert(compacted, BINARY + '.compact')
+    with watcher.lock:
+        if watcher.stamp() != loaded:
+            os.remove(compacted)
+            os.remove(BINARY + '.compact')
+            print(f"{CATALOG} changed while compacting, keeping {wal.path}")
+            return
+        os.replace(compacted, CATALOG)
+        os.replace(BINARY + '.compact', BINARY)
+        wal.truncate(position)
+    print(f"Compacted {wal.path} into {CATALOG} and {BINARY}")
+
+
+wal = WriteAheadLog(LOG)
+watcher = CatalogWatcher([CATALOG], load, prepare=catch_up,
+                         follow=follow_log)
+compactor = Compactor(wal, compact)
+response_cache = ResponseCache()
+similar_books = SimilarBooks()
+duplicate_finder = DuplicateFinder()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    wal.start()
+    watcher.start()
+    compactor.start()
+    yield
+    compactor.stop()
+    watcher.stop()
+    wal.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+app.include_router(profile_router)
+
+
+def current_catalog():
+    catalog = watcher.catalog
+    if catalog is None:
+        raise HTTPException(status_code=503, detail="Catalog is loading")
+    return catalog
+
+
+def parse_fields(fields):
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in BOOK_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+
+def book_filters(author: List[str] = Query(None),
+                 category: List[str] = Query(None),
+                 status: List[str] = Query(None),
+                 published_from: Optional[date] = None,
+                 published_to: Optional[date] = None,
+                 min_pages: Optional[int] = Query(None, ge=0),
+                 max_pages: Optional[int] = Query(None, ge=0)):
+    filters = {'author': author, 'category': category, 'status': status}
+    filters = {name: values for name, values in filters.items() if values}
+    if published_from is not None or published_to is not None:
+        filters['published'] = (
+            date_millis(published_from) if published_from else None,
+            date_millis(published_to, end=True) if published_to else None)
+    if min_pages is not None or max_pages is not None:
+        filters['pages'] = (min_pages, max_pages)
+    return filters
+
+
+def filters_key(filters):
+    key = []
+    for name, values in filters.items():
+        if name in FILTER_FIELDS:
+            values = sorted(set(map(normalize, values)))
+        key.append((name, tuple(values)))
+    return tuple(sorted(key))
 
 
 @app.get("/")
@@ -14,22 +197,253 @@ def main():
     }
 
 
+@app.get("/metrics")
+def get_metrics():
+    return metrics_response()
+
+
+@app.get("/ready")
+def ready():
+    catalog = watcher.catalog
+    if catalog is None:
+        return JSONResponse({"status": "loading"}, status_code=503)
+    return {
+        "status": "ready",
+        "books": len(catalog)
+    }
+
+
 @app.get("/books")
-def get_all_books():
+def get_all_books(request: Request,
+                  limit: int = Query(100, ge=1, le=1000),
+                  cursor: Optional[str] = None,
+                  fields: Optional[str] = None,
+                  filters: dict = Depends(book_filters)):
+    catalog = current_catalog()
+    names = parse_fields(fields)
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    def build():
+        rows = catalog.filter(filters) if filters else None
+        books, last = catalog.page(limit, after, rows)
+        return {
+            "message": [project(book, names) for book in books],
+            "next_cursor": encode_cursor(last) if last is not None else None
+        }
+
+    key = ('books', catalog.version, limit, after,
+           tuple(names) if names is not None else None,
+           filters_key(filters))
+    return cached_json(request, response_cache, key, build)
+
+
+@app.get("/books/facets")
+def get_facets(request: Request,
+               size: int = Query(20, ge=1, le=1000),
+               filters: dict = Depends(book_filters)):
+    catalog = current_catalog()
+
+    def build():
+        rows = catalog.filter(filters) if filters else None
+        return {
+            "message": catalog.facets().count(rows, size)
+        }
+
+    key = ('facets', catalog.version, size, filters_key(filters))
+    return cached_json(request, response_cache, key, build)
+
+
+@app.get("/books/search")
+def search_books(request: Request,
+                 q: str = Query(..., min_length=1),
+                 k: int = Query(10, ge=1, le=100),
+                 fuzzy: bool = False):
+    catalog = current_catalog()
+
+    def build():
+        if fuzzy:
+            results, total = catalog.fuzzy_search(q, k)
+        else:
+            results, total = catalog.search(q, k)
+        return {
+            "message": results,
+            "total": total
+        }
+
+    key = ('search', catalog.version, normalize_query(q, fuzzy), k, fuzzy)
+    return cached_json(request, response_cache, key, build)
+
+
+@app.get("/books/suggest")
+def suggest_books(prefix: str = Query(..., min_length=1),
+                  n: int = Query(10, ge=1, le=50)):
+    catalog = current_catalog()
+    with timed('catalog'):
+        results = catalog.suggest(prefix, n)
+    return {
+        "message": results
+    }
+
+
+@app.get("/books/stream")
+def stream_books(request: Request):
+    catalog = current_catalog()
+    chunks = ndjson_chunks(book.to_dict() for book in catalog)
+    headers = {'Vary': 'Accept-Encoding'}
+    if accepts_gzip(request):
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return StreamingResponse(chunks, media_type='application/x-ndjson',
+                             headers=headers)
+
+
+@app.get("/books/duplicates")
+def get_duplicate_books(x_duplicates_token: Optional[str] = Header(None)):
+    # guarded like /debug/profile: needs DUPLICATES_TOKEN sent back in
+    # X-Duplicates-Token
+    require_token(x_duplicates_token, 'DUPLICATES_TOKEN')
+    catalog = current_catalog()
+    duplicates = duplicate_finder.duplicates(catalog)
+    if duplicates is None:
+        return JSONResponse({"status": "running"}, status_code=202)
     return {
-        "message": data
+        "message": duplicates
     }
 
 
+@app.get("/books/batch")
+def get_books_batch(isbn: str = Query(..., min_length=1)):
+    isbns = [value.strip() for value in isbn.split(',') if value.strip()]
+    if len(isbns) > 100:
+        raise HTTPException(
+            status_code=400,
+            detail="At most 100 ISBNs per GET, use POST /books/batch")
+    catalog = current_catalog()
+    with timed('catalog'):
+        return get_books_by_isbn(catalog, isbns)
+
+
+@app.post("/books/batch")
+def post_books_batch(batch: IsbnBatch):
+    catalog = current_catalog()
+    with timed('catalog'):
+        return get_books_by_isbn(catalog, batch.isbns)
+
+
 @app.get("/books/{isbn}")
-def get_book(isbn):
-    return get_book_by_isbn(isbn)
+def get_book(request: Request, isbn):
+    catalog = current_catalog()
+    book = catalog.get(isbn)
+    if book is None:
+        raise HTTPException(status_code=404, detail=f"No books with {isbn}")
+    key = ('book', catalog.version, isbn)
+    return cached_json(request, response_cache, key, book.to_dict)
+
 
+@app.get("/books/{isbn}/similar")
+def get_similar_books(isbn, k: int = Query(10, ge=1, le=100)):
+    catalog = current_catalog()
+    row = catalog.row(isbn)
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"No books with {isbn}")
+    with timed('catalog'):
+        results = similar_books.similar(catalog, row, k)
+    if results is None:
+        raise HTTPException(status_code=503,
+                            detail="Similar books index is building")
+    return {
+        "message": results
+    }
 
-@app.post("/books")
+
+@app.post("/books", status_code=201)
 def insert_book(book: Books):
+    record = book.model_dump()
+    # the log lock makes the check and the append atomic across workers
+    with watcher.lock, wal.exclusive():
+        catalog = watcher.catalog = follow_log(current_catalog())
+        if catalog.get(record['isbn']) is not None:
+            raise HTTPException(
+                status_code=409,
+                detail=f"A book with isbn {record['isbn']} already exists")
+        with timed('wal'):
+            seq = wal.append([record])
+        # readers keep whichever catalog they already took
+        with timed('catalog'):
+            watcher.catalog, _ = catalog.with_records([record])
+    # outside the lock, so concurrent inserts share one fsync
+    with timed('wal'):
+        wal.wait_synced(seq)
     return {'message': book}
 
 
+def insert_books(books):
+    # books: [(line number, record)], applied with one log append and one
+    # catalog update
+    accepted, errors, seen = [], [], set()
+    with watcher.lock, wal.exclusive():
+        catalog = watcher.catalog = follow_log(current_catalog())
+        for n, record in books:
+            isbn = record['isbn']
+            if isbn in seen or catalog.get(isbn) is not None:
+                errors.append({'line': n, 'errors': [{
+                    'type': 'duplicate_isbn',
+                    'loc': ['isbn'],
+                    'msg': f"A book with isbn {isbn} already exists"}]})
+                continue
+            seen.add(isbn)
+            accepted.append(record)
+        if accepted:
+            seq = wal.append(accepted)
+            watcher.catalog, _ = catalog.with_records(accepted)
+    if accepted:
+        wal.wait_synced(seq)
+    return accepted, errors
+
+
+@app.post("/books/bulk")
+async def insert_books_bulk(request: Request, batch_size: int = 1000):
+    books, errors = [], []
+    lines, pending, first_line = [], b'', 1
+    async for chunk in request.stream():
+        *complete, pending = (pending + chunk).split(b'\n')
+        lines.extend(complete)
+        if len(lines) >= batch_size:
+            valid, invalid = await run_in_threadpool(
+                validate_lines, lines, first_line)
+            books.extend(valid)
+            errors.extend(invalid)
+            first_line += len(lines)
+            lines = []
+    lines.append(pending)
+    valid, invalid = await run_in_threadpool(validate_lines, lines, first_line)
+    books.extend(valid)
+    errors.extend(invalid)
+
+    accepted, duplicates = await run_in_threadpool(insert_books, books)
+    errors.extend(duplicates)
+    errors.sort(key=lambda error: error['line'])
+    return {
+        'accepted': len(accepted),
+        'rejected': len(errors),
+        'errors': errors
+    }
+
+
+def serve():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+    if args.workers == 1:
+        uvicorn.run("books:app", reload=True)
+        return
+    uvicorn.run("books:app", workers=args.workers)
+
+
 if __name__ == "__main__":
-    uvicorn.run("books:app", reload=True)
+    serve()
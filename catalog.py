@@ -0,0 +1,386 @@
+import base64
+import binascii
+import heapq
+import itertools
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from bookrecord import as_record
+from facets import Facets
+from postings import EMPTY, ROW, csr, find, intersect
+from search import (SearchIndex, TrigramIndex, fuzzy_search_all, search_all,
+                    snippet)
+
+_versions = itertools.count(1)
+
+# query parameter -> record field
+FILTER_FIELDS = {
+    'author': 'authors',
+    'category': 'categories',
+    'status': 'status',
+}
+# range filter -> numeric BookRecord attribute, filtered as (low, high)
+# with both ends inclusive and None for an open end
+RANGE_FIELDS = {
+    'published': 'published',
+    'pages': 'pageCount',
+}
+
+
+class Catalog:
+    # An immutable list of books with its indexes, made of segments that
+    # each cover a run of rows. Nothing changes once a catalog is built:
+    # with_records() returns a new catalog sharing these segments, so a
+    # request that took a catalog reads consistent indexes however many
+    # inserts land while it runs.
+    def __init__(self, records=(), store=None, segments=None):
+        # unique per catalog instance, used to key anything derived from it
+        self.version = next(_versions)
+        if segments is None:
+            # store: a read-only record store such as a BinaryCatalog that
+            # decodes records on access
+            if store is None:
+                store = [as_record(record) for record in records]
+            segments = [Segment(0, store)]
+        self.segments = tuple(segments)
+        # row id -> BookRecord
+        self.records = Rows(self.segments)
+        self._facets = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def with_records(self, records):
+        # -> (catalog with the new books, BookRecords added), skipping
+        # ISBNs the catalog already has. New books go into a segment of
+        # their own; trailing segments are merged while one is no bigger
+        # than the next, so there are O(log n) of them and each book is
+        # re-indexed O(log n) times. The first segment, usually the loaded
+        # catalog, is never merged.
+        added, seen = [], set()
+        for record in records:
+            record = as_record(record)
+            isbn = record.isbn
+            if isbn is not None:
+                if isbn in seen or self.row(isbn) is not None:
+                    continue
+                seen.add(isbn)
+            added.append(record)
+        if not added:
+            return self, added
+        segments = list(self.segments)
+        segments.append(Segment(len(self), added))
+        while len(segments) > 2 and segments[-2].count <= segments[-1].count:
+            last, previous = segments.pop(), segments.pop()
+            segments.append(Segment(previous.start, list(previous.records)
+                                    + list(last.records)))
+        return Catalog(segments=segments), added
+
+    def __iter__(self):
+        for segment in self.segments:
+            for row in range(segment.count):
+                yield segment.records[row]
+
+    def row(self, isbn):
+        # books.json has a few repeated ISBNs, the first one wins like the
+        # old linear scan did
+        for segment in self.segments:
+            row = segment.row(isbn)
+            if row is not None:
+                return row
+        return None
+
+    def get(self, isbn):
+        row = self.row(isbn)
+        return self.records[row] if row is not None else None
+
+    def filter(self, filters):
+        # -> sorted array of the rows matching every filter
+        return np.concatenate([
+            segment.filter(filters).astype(np.int64) + segment.start
+            for segment in self.segments])
+
+    def facets(self):
+        facets = self._facets
+        if facets is None:
+            facets = self._facets = Facets(self)
+        return facets
+
+    def page(self, limit, after=None, rows=None):
+        if rows is None:
+            keys = heapq.merge(*(segment.ordered(after)
+                                 for segment in self.segments))
+        else:
+            cuts = np.searchsorted(
+                rows, [segment.start for segment in self.segments[1:]])
+            keys = heapq.merge(*(
+                segment.first(part - segment.start, limit + 1, after)
+                for segment, part in zip(self.segments, np.split(rows, cuts))))
+        keys = list(itertools.islice(keys, limit + 1))
+        books = [self.records[row] for _, row in keys[:limit]]
+        if len(keys) > limit:
+            return books, keys[limit - 1]
+        return books, None
+
+    def suggest(self, prefix, n=10):
+        prefix = prefix.casefold()
+        titles = []
+        for segment in self.segments:
+            start = bisect_left(segment.titles, prefix)
+            for i in range(start, min(start + n, len(segment.titles))):
+                title = segment.titles[i]
+                if not title.startswith(prefix):
+                    break
+                titles.append((title, segment.start
+                               + int(segment.title_rows[i])))
+        results = []
+        for _, row in sorted(titles)[:n]:
+            record = self.records[row]
+            results.append({'title': record.title, 'isbn': record.isbn})
+        return results
+
+    def search(self, q, k=10):
+        hits, total = search_all(
+            [(segment.start, segment.text) for segment in self.segments],
+            q, k)
+        results = []
+        for row, score in hits:
+            record = self.records[row]
+            results.append({
+                'isbn': record.isbn,
+                'title': record.title,
+                'score': round(score, 4),
+                'snippet': snippet(record, q),
+            })
+        return results, total
+
+    def fuzzy_search(self, q, k=10):
+        hits, total = fuzzy_search_all(
+            [(segment.start, segment.fuzzy) for segment in self.segments],
+            q, k)
+        results = []
+        for row, edits in hits:
+            record = self.records[row]
+            results.append({
+                'isbn': record.isbn,
+                'title': record.title,
+                'edits': edits,
+            })
+        return results, total
+
+
+class Segment:
+    # Indexes over the rows start .. start + count - 1, fixed once built.
+    # Row ids inside a segment are relative to its start.
+    #
+    # isbn -> catalog row, built on first lookup; a segment mapped from
+    # books.bin builds it once per worker
+    _rows_by_isbn = None
+
+    def __init__(self, start, records):
+        self.start = start
+        self.records = records
+        self.count = len(records)
+        isbns, titles = [], []
+        values = {name: [] for name in FIELDS}
+        numbers = {name: [] for name in RANGE_FIELDS}
+        for record in records:
+            isbns.append(record.isbn)
+            titles.append(record.title)
+            for name, field in FILTER_FIELDS.items():
+                values[name].append(field_values(record, field))
+            if record.published is not None:
+                year = published_year(record)
+                values['year'].append({year: year})
+            else:
+                values['year'].append({})
+            for name, field in RANGE_FIELDS.items():
+                numbers[name].append(getattr(record, field))
+
+        # rows in (isbn, row) order, records without an isbn sort first
+        order = sorted(range(self.count),
+                       key=lambda row: (isbns[row] or '', row))
+        self.isbns = [isbns[row] or '' for row in order]
+        self.isbn_rows = np.array(order, dtype=ROW)
+        # row -> its position in that order
+        self.ranks = np.empty(self.count, dtype=ROW)
+        self.ranks[self.isbn_rows] = np.arange(self.count, dtype=ROW)
+        self.has_isbn = np.array([isbn is not None for isbn in isbns],
+                                 dtype=bool)
+        # casefolded titles in order, for prefix lookups
+        order = sorted((title.casefold(), row)
+                       for row, title in enumerate(titles) if title)
+        self.titles = [title for title, _ in order]
+        self.title_rows = np.array([row for _, row in order], dtype=ROW)
+        self.fields = {name: FieldIndex(rows) for name, rows in values.items()}
+        self.ranges = {name: RangeIndex(numbers[name])
+                       for name in RANGE_FIELDS}
+        self.text = SearchIndex(records)
+        self.fuzzy = TrigramIndex(titles)
+
+    def row(self, isbn):
+        rows = self._rows_by_isbn
+        if rows is None:
+            rows = {}
+            has_isbn = self.has_isbn.tolist()
+            # in (isbn, row) order, so the first row of an isbn wins
+            for key, row in zip(self.isbns, self.isbn_rows.tolist()):
+                if has_isbn[row] and key not in rows:
+                    rows[key] = self.start + row
+            self._rows_by_isbn = rows
+        return rows.get(isbn)
+
+    def position(self, after):
+        # -> rank of the first row that sorts after the (isbn, row) key
+        if after is None:
+            return 0
+        isbn, row = after
+        n = bisect_left(self.isbns, isbn)
+        end = bisect_right(self.isbns, isbn, n)
+        return n + int(np.searchsorted(self.isbn_rows[n:end],
+                                       row - self.start, 'right'))
+
+    def ordered(self, after=None):
+        # (isbn or '', catalog row) pairs in order, from just past `after`
+        for n in range(self.position(after), self.count):
+            yield self.isbns[n], self.start + int(self.isbn_rows[n])
+
+    def first(self, rows, n, after=None):
+        # -> the first n of these local rows past `after` as (isbn or '',
+        # catalog row) pairs in order; ranks keep the sort in NumPy and
+        # only n keys are built
+        ranks = self.ranks[rows]
+        if after is not None:
+            ranks = ranks[ranks >= self.position(after)]
+        if len(ranks) > n:
+            ranks = np.partition(ranks, n - 1)[:n]
+        ranks.sort()
+        return [(self.isbns[rank], self.start + int(self.isbn_rows[rank]))
+                for rank in ranks.tolist()]
+
+    def filter(self, filters):
+        # -> sorted array of this segment's rows matching every filter
+        lists = []
+        for name, values in filters.items():
+            if name in RANGE_FIELDS:
+                lists.append(self.ranges[name].rows(*values))
+                continue
+            for value in values:
+                rows = self.fields[name].rows(normalize(value))
+                if not len(rows):
+                    return EMPTY
+                lists.append(rows)
+        lists.sort(key=len)
+        rows = lists[0]
+        for other in lists[1:]:
+            rows = intersect(rows, other)
+        return rows
+
+
+# filter fields plus the publication year (in the record's own timezone),
+# which is only used as a facet
+FIELDS = tuple(FILTER_FIELDS) + ('year',)
+
+
+class FieldIndex:
+    # One field of a segment: its distinct normalized values in order, the
+    # spelling first seen for each, the rows with each value and the values
+    # of each row.
+    def __init__(self, rows):
+        # rows: {normalized value: spelling} per row
+        labels = {}
+        for values in rows:
+            for value, label in values.items():
+                labels.setdefault(value, label)
+        self.values = sorted(labels)
+        self.labels = [labels[value] for value in self.values]
+        ids = {value: n for n, value in enumerate(self.values)}
+        row_values = [[ids[value] for value in values] for values in rows]
+        value_rows = [[] for _ in self.values]
+        for row, values in enumerate(row_values):
+            for n in values:
+                value_rows[n].append(row)
+        self.offsets, self.value_rows = csr(value_rows)
+        self.row_offsets, self.row_values = csr(row_values)
+
+    def rows(self, value):
+        # -> sorted rows with this normalized value
+        n = find(self.values, value)
+        if n < 0:
+            return EMPTY
+        return self.value_rows[self.offsets[n]:self.offsets[n + 1]]
+
+
+class RangeIndex:
+    # Values of one numeric column sorted, with their rows, so a range is
+    # two searchsorted calls
+    def __init__(self, values):
+        rows = [row for row, value in enumerate(values) if value is not None]
+        values = np.array([values[row] for row in rows], dtype=np.int64)
+        order = np.argsort(values, kind='stable')
+        self.values = values[order]
+        self.rows_by_value = np.array(rows, dtype=ROW)[order]
+
+    def rows(self, low=None, high=None):
+        # sorted row ids with low <= value <= high
+        start = 0 if low is None else np.searchsorted(self.values, low, 'left')
+        end = (len(self.values) if high is None
+               else np.searchsorted(self.values, high, 'right'))
+        return np.sort(self.rows_by_value[start:end])
+
+
+class Rows:
+    # Row id -> BookRecord across the segments of a catalog
+    def __init__(self, segments):
+        self.segments = segments
+        self.starts = [segment.start for segment in segments]
+
+    def __len__(self):
+        return self.segments[-1].start + self.segments[-1].count
+
+    def __getitem__(self, row):
+        segment = self.segments[bisect_right(self.starts, row) - 1]
+        return segment.records[row - segment.start]
+
+
+def normalize(value):
+    return value.strip().casefold()
+
+
+def field_values(record, field):
+    # -> {normalized value: value as written}
+    values = getattr(record, field)
+    if values is None:
+        return {}
+    if isinstance(values, str):
+        values = [values]
+    return {normalize(value): value.strip()
+            for value in values if value and value.strip()}
+
+
+def published_year(record):
+    tz = timezone(timedelta(minutes=record.publishedOffset))
+    return datetime.fromtimestamp(record.published / 1000, tz).year
+
+
+def encode_cursor(key):
+    isbn, row = key
+    raw = f'{isbn}:{row}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        isbn, row = raw.decode().rsplit(':', 1)
+        return isbn, int(row)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'Invalid cursor {cursor!r}')
+
+
+def project(book, fields):
+    if fields is None:
+        return book.to_dict()
+    return book.to_dict(fields)
@@ -0,0 +1,155 @@
+import json
+import sys
+import threading
+import time
+import traceback
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from search import tokenize
+
+NUM_PERM = 128
+# 16 bands of 8 rows: pairs above ~0.7 Jaccard almost always share a band
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+THRESHOLD = 0.8
+SHINGLE = 3
+PRIME = np.uint64(4294967311)
+
+_rng = np.random.default_rng(1)
+_A = _rng.integers(1, 1 << 32, NUM_PERM, dtype=np.uint64)[:, None]
+_B = _rng.integers(0, 1 << 32, NUM_PERM, dtype=np.uint64)[:, None]
+
+
+def shingles(record):
+    text = ' '.join(filter(None, (record.shortDescription,
+                                  record.longDescription)))
+    tokens = tokenize(text)
+    if len(tokens) < SHINGLE:
+        return None
+    hashed = {zlib.crc32(' '.join(tokens[i:i + SHINGLE]).encode())
+              for i in range(len(tokens) - SHINGLE + 1)}
+    return np.fromiter(hashed, dtype=np.uint64, count=len(hashed))
+
+
+def signature(values):
+    # min over the shingles of NUM_PERM universal hashes (a * x + b) mod p;
+    # a, x < 2**32 so nothing overflows uint64
+    return ((_A * values[None, :] + _B) % PRIME).min(axis=1)
+
+
+def find_duplicates(records, threshold=THRESHOLD):
+    # records: iterable of (row, BookRecord) -> clusters of
+    # (rows, min estimated Jaccard similarity), largest first
+    rows, signatures = [], []
+    for row, record in records:
+        values = shingles(record)
+        if values is not None:
+            rows.append(row)
+            signatures.append(signature(values))
+    if not signatures:
+        return []
+    signatures = np.vstack(signatures)
+
+    candidates = set()
+    for band in range(BANDS):
+        buckets = defaultdict(list)
+        block = signatures[:, band * ROWS:(band + 1) * ROWS]
+        for n, key in enumerate(np.ascontiguousarray(block)):
+            buckets[key.tobytes()].append(n)
+        for members in buckets.values():
+            # compare against the first member only, so a big bucket costs
+            # linear rather than quadratic work
+            candidates.update((members[0], n) for n in members[1:])
+
+    parent = list(range(len(rows)))
+
+    def find(n):
+        while parent[n] != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+
+    similarity = {}
+    for a, b in candidates:
+        estimate = float(np.mean(signatures[a] == signatures[b]))
+        if estimate >= threshold:
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[root_b] = root_a
+            similarity[a] = min(similarity.get(a, 1.0), estimate)
+            similarity[b] = min(similarity.get(b, 1.0), estimate)
+
+    clusters = defaultdict(list)
+    for n in similarity:
+        clusters[find(n)].append(n)
+    result = [(sorted(rows[n] for n in members),
+               min(similarity[n] for n in members))
+              for members in clusters.values()]
+    result.sort(key=lambda cluster: (-len(cluster[0]), cluster[0]))
+    return result
+
+
+def duplicates(catalog):
+    return [{
+        'similarity': round(estimate, 3),
+        'books': [{'isbn': catalog.records[row].isbn,
+                   'title': catalog.records[row].title}
+                  for row in rows],
+    } for rows, estimate in find_duplicates(enumerate(catalog))]
+
+
+class DuplicateFinder:
+    # Finds the duplicates of the latest catalog version in a background
+    # thread, at most once every `min_interval` seconds; requests only read
+    # the last result, which names its books so it outlives the catalog it
+    # was found in.
+    def __init__(self, min_interval=60.0):
+        self.min_interval = min_interval
+        self.version = None
+        self.result = None
+        self.lock = threading.Lock()
+        self.running = False
+        self.started = None
+
+    def refresh(self, catalog):
+        with self.lock:
+            if self.running or self.version == catalog.version:
+                return
+            if (self.started is not None
+                    and time.monotonic() - self.started < self.min_interval):
+                return
+            self.running = True
+            self.started = time.monotonic()
+        threading.Thread(target=self._run, args=(catalog,),
+                         name='duplicate-finder', daemon=True).start()
+
+    def _run(self, catalog):
+        try:
+            result = duplicates(catalog)
+            with self.lock:
+                self.version, self.result = catalog.version, result
+        except Exception:
+            print("Finding duplicate books failed")
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.running = False
+
+    def duplicates(self, catalog):
+        # -> the last result, or None until the first one is ready
+        self.refresh(catalog)
+        return self.result
+
+
+if __name__ == "__main__":
+    from catalog import Catalog
+    from loader import iter_records
+
+    if len(sys.argv) != 2:
+        sys.exit("usage: python dedupe.py books.json")
+    catalog = Catalog(iter_records(sys.argv[1]))
+    json.dump(duplicates(catalog), sys.stdout, indent=2)
+    print()
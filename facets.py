@@ -0,0 +1,57 @@
+from collections import Counter
+
+import numpy as np
+
+from postings import ROW, gather
+
+FACETS = ('category', 'status', 'author', 'year')
+
+
+class Facets:
+    # Facet counts for one catalog. Every segment counts its own values and
+    # the counts are merged by normalized value, labelled with the first
+    # spelling seen in row order. Unfiltered counts are computed here once;
+    # filtered counts tally the values of the filtered rows.
+    def __init__(self, catalog):
+        self.segments = catalog.segments
+        self.labels = {name: {} for name in FACETS}
+        totals = {name: Counter() for name in FACETS}
+        for segment in self.segments:
+            for name in FACETS:
+                field = segment.fields[name]
+                for value, label in zip(field.values, field.labels):
+                    self.labels[name].setdefault(value, label)
+                totals[name].update(dict(zip(
+                    field.values, np.diff(field.offsets).tolist())))
+        self.counts = {name: ranked(totals[name].items())
+                       for name in FACETS}
+
+    def count(self, rows=None, size=20):
+        if rows is None:
+            counts = self.counts
+        else:
+            totals = {name: Counter() for name in FACETS}
+            cuts = np.searchsorted(
+                rows, [segment.start for segment in self.segments[1:]])
+            for segment, part in zip(self.segments, np.split(rows, cuts)):
+                if not len(part):
+                    continue
+                part = (part - segment.start).astype(ROW)
+                for name in FACETS:
+                    field = segment.fields[name]
+                    tally = np.bincount(
+                        gather(field.row_offsets, field.row_values, part),
+                        minlength=len(field.values))
+                    totals[name].update({field.values[n]: int(tally[n])
+                                         for n in np.flatnonzero(tally)})
+            counts = {name: ranked(totals[name].items()) for name in FACETS}
+        return {
+            name: [{'value': self.labels[name][value], 'count': count}
+                   for value, count in counts[name][:size]]
+            for name in FACETS
+        }
+
+
+def ranked(pairs):
+    return sorted(((value, count) for value, count in pairs if count),
+                  key=lambda pair: (-pair[1], str(pair[0])))
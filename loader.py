@@ -0,0 +1,72 @@
+import codecs
+import json
+import os
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_records(source, chunk_size=1 << 16, progress=None, every=10000):
+    # Parse a top-level JSON array one element at a time, keeping only the
+    # unparsed tail of the file in memory. `source` is a path or a file
+    # opened in binary mode, which is read from the start and left open.
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield from _iter_records(f, chunk_size, progress, every)
+    else:
+        source.seek(0)
+        yield from _iter_records(source, chunk_size, progress, every)
+
+
+def _iter_records(f, chunk_size, progress, every):
+    path = f.name
+    total = os.fstat(f.fileno()).st_size
+    count = 0
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        data = f.read(chunk_size)
+        if not data:
+            eof = True
+        buf = buf[pos:] + decoder.decode(data, final=eof)
+        pos = 0
+
+    def skip(separators=''):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE + separators:
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    skip()
+    if pos == len(buf) or buf[pos] != '[':
+        raise ValueError(f'{path} does not contain a JSON array')
+    pos += 1
+
+    while True:
+        skip(',')
+        if pos == len(buf):
+            raise ValueError(f'{path} ends before the closing ]')
+        if buf[pos] == ']':
+            break
+        try:
+            record, end = _decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        pos = end
+        count += 1
+        if progress is not None and count % every == 0:
+            progress(count, f.tell(), total)
+        yield record
+
+    if progress is not None:
+        progress(count, total, total)
@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no flock on Windows, where the app runs as a single process
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path, shared=False, wait=True):
+    # Advisory lock shared by every process opening `path`, created if
+    # missing and never removed. Yields whether the lock was taken, which
+    # is always True unless wait is False.
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            try:
+                fcntl.flock(f.fileno(), mode if wait else mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+        # closing the file releases the lock
+        yield True
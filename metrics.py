@@ -0,0 +1,172 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.responses import PlainTextResponse
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# phase -> seconds spent in it during the current request
+_phases = ContextVar('phases', default=None)
+
+
+def record(phase, seconds):
+    phases = _phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    # Adds the time spent in the block to `phase` for the current request;
+    # it shows up in Server-Timing and in http_request_phase_seconds.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        # (method, route, status) -> Histogram
+        self.latency = {}
+        self.sizes = {}
+        # (route, phase) -> [seconds, count]
+        self.phases = defaultdict(lambda: [0.0, 0])
+
+    def observe(self, method, route, status, seconds, size, phases):
+        key = method, route, str(status)
+        with self.lock:
+            latency = self.latency.get(key)
+            if latency is None:
+                latency = self.latency[key] = Histogram(LATENCY_BUCKETS)
+                self.sizes[key] = Histogram(SIZE_BUCKETS)
+            latency.observe(seconds)
+            self.sizes[key].observe(size)
+            for phase, spent in phases.items():
+                total = self.phases[route, phase]
+                total[0] += spent
+                total[1] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines += [
+                '# HELP http_requests_in_flight Requests being handled.',
+                '# TYPE http_requests_in_flight gauge',
+                f'http_requests_in_flight {self.in_flight}',
+            ]
+            _histogram(lines, 'http_request_duration_seconds',
+                       'Time to handle a request, by route.', self.latency)
+            _histogram(lines, 'http_response_size_bytes',
+                       'Response body size, by route.', self.sizes)
+            lines += [
+                '# HELP http_request_phase_seconds Time spent in named '
+                'phases of a request, such as catalog or db.',
+                '# TYPE http_request_phase_seconds summary',
+            ]
+            for (route, phase), (spent, count) in sorted(self.phases.items()):
+                labels = _labels(route=route, phase=phase)
+                lines.append(f'http_request_phase_seconds_sum{{{labels}}} '
+                             f'{spent}')
+                lines.append(f'http_request_phase_seconds_count{{{labels}}} '
+                             f'{count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _histogram(lines, name, help, histograms):
+    lines.append(f'# HELP {name} {help}')
+    lines.append(f'# TYPE {name} histogram')
+    for (method, route, status), histogram in sorted(histograms.items()):
+        labels = _labels(method=method, route=route, status=status)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ('+Inf',),
+                                histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} '
+                         f'{cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+
+def _labels(**labels):
+    return ','.join(
+        f'{name}="' + value.replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n') + '"'
+        for name, value in labels.items())
+
+
+def server_timing(total, phases):
+    parts = [f'{phase};dur={seconds * 1000:.3f}'
+             for phase, seconds in phases.items()]
+    parts.append(f'total;dur={total * 1000:.3f}')
+    return ', '.join(parts)
+
+
+REGISTRY = Metrics()
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: one perf_counter pair, a contextvar and a
+    # lock per request, so it can stay on in production. Routes are
+    # labelled by their template (/books/{isbn}), unmatched paths as
+    # "unmatched", to keep the label set bounded.
+    def __init__(self, app, metrics=REGISTRY):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        phases = {}
+        token = _phases.set(phases)
+        status, size = 500, 0
+
+        async def send_with_timing(message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                timing = server_timing(time.perf_counter() - start, phases)
+                headers = list(message.get('headers', ()))
+                headers.append((b'server-timing', timing.encode()))
+                message = {**message, 'headers': headers}
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        self.metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            self.metrics.in_flight -= 1
+            _phases.reset(token)
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            self.metrics.observe(scope['method'], route, status,
+                                 time.perf_counter() - start, size, phases)
+
+
+def metrics_response(metrics=REGISTRY):
+    return PlainTextResponse(metrics.render(),
+                             media_type='text/plain; version=0.0.4')
@@ -0,0 +1,47 @@
+import itertools
+from bisect import bisect_left
+
+import numpy as np
+
+# row ids inside a segment
+ROW = np.int32
+EMPTY = np.empty(0, dtype=ROW)
+
+
+def find(keys, key):
+    # -> index of key in the sorted sequence keys, or -1
+    n = bisect_left(keys, key)
+    return n if n < len(keys) and keys[n] == key else -1
+
+
+def csr(lists, dtype=ROW):
+    # list of lists -> (offsets, values), list n being
+    # values[offsets[n]:offsets[n + 1]]
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(values) for values in lists], out=offsets[1:])
+    values = np.fromiter(itertools.chain.from_iterable(lists), dtype=dtype,
+                         count=int(offsets[-1]))
+    return offsets, values
+
+
+def gather(offsets, values, items):
+    # the CSR lists of `items`, concatenated
+    starts = offsets[items]
+    lengths = offsets[items + 1] - starts
+    ends = np.cumsum(lengths)
+    index = np.arange(ends[-1] if len(ends) else 0)
+    index += np.repeat(starts - (ends - lengths), lengths)
+    return values[index]
+
+
+def intersect(a, b):
+    # sorted unique arrays -> sorted array of the values in both; looks up
+    # the shorter one in the longer so a rare value meets a common one in
+    # O(short * log long)
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a
+    at = np.searchsorted(b, a)
+    at[at == len(b)] = 0
+    return a[b[at] == a]
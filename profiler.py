@@ -0,0 +1,140 @@
+import hmac
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from html import escape
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse, Response
+
+MAX_SECONDS = 60
+INTERVAL = 0.005
+# innermost frames of threads that are parked rather than working: lock and
+# condition waits, the event loop's select, idle executor threads
+IDLE = {('threading.py', 'wait'), ('selectors.py', 'select'),
+        ('thread.py', '_worker')}
+
+_running = threading.Lock()
+
+# /debug/profile, included by every app that wants it
+router = APIRouter()
+
+
+def frame_name(code):
+    filename = os.path.basename(code.co_filename)
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})' \
+        .replace(';', ':')
+
+
+def sample(seconds, interval=INTERVAL, idle=False):
+    # Walks every other thread's stack each `interval` for `seconds`.
+    # -> Counter of collapsed stacks ("thread;outer;...;inner") to samples
+    me = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            if not idle and (os.path.basename(code.co_filename),
+                             code.co_name) in IDLE:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f'thread-{ident}'))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks):
+    return ''.join(f'{stack} {count}\n'
+                   for stack, count in sorted(stacks.items()))
+
+
+def flamegraph(stacks, width=1200, row=16):
+    # root at the bottom, one row per frame, widths proportional to samples
+    root = [0, {}]
+    for stack, count in stacks.items():
+        node = root
+        node[0] += count
+        for name in stack.split(';'):
+            node = node[1].setdefault(name, [0, {}])
+            node[0] += count
+
+    def depth(node):
+        return 1 + max(map(depth, node[1].values()), default=0)
+
+    height = (depth(root) - 1) * row + 30
+    total = root[0] or 1
+    rects = []
+
+    def draw(children, x, level):
+        y = height - (level + 1) * row
+        for name, (count, grandchildren) in sorted(children.items()):
+            w = count / total * width
+            if w >= 0.1:
+                hue = zlib.crc32(name.encode()) % 50
+                label = name if len(name) * 7 < w - 6 \
+                    else name[:max(int((w - 6) / 7) - 2, 0)] + '..'
+                rects.append(
+                    f'<g><title>{escape(name)} ({count} samples, '
+                    f'{count * 100 / total:.2f}%)</title>'
+                    f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" '
+                    f'height="{row - 1}" fill="hsl({hue},85%,60%)"/>'
+                    + (f'<text x="{x + 3:.1f}" y="{y + row - 4}">'
+                       f'{escape(label)}</text>' if w > 30 else '')
+                    + '</g>')
+                draw(grandchildren, x, level + 1)
+            x += w
+
+    draw(root[1], 0, 0)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" '
+            f'height="{height}" font-family="monospace" font-size="12">'
+            f'<text x="4" y="16">{total} samples</text>'
+            + ''.join(rects) + '</svg>')
+
+
+def require_token(token, variable):
+    # Endpoints guarded by this are off unless the environment variable is
+    # set, and then only answer callers sending its value back.
+    expected = os.environ.get(variable)
+    if not expected:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token.encode(),
+                                            expected.encode()):
+        raise HTTPException(status_code=403, detail="Invalid token")
+
+
+def profile_response(token, seconds, format='collapsed', idle=False):
+    # Needs PROFILE_TOKEN sent back in X-Profile-Token. One profile runs at
+    # a time.
+    require_token(token, 'PROFILE_TOKEN')
+    if not _running.acquire(blocking=False):
+        raise HTTPException(status_code=409,
+                            detail="A profile is already running")
+    try:
+        stacks = sample(seconds, idle=idle)
+    finally:
+        _running.release()
+    if format == 'svg':
+        return Response(flamegraph(stacks), media_type='image/svg+xml')
+    return PlainTextResponse(collapsed(stacks))
+
+
+# sync so the sampling sleeps in a threadpool thread, not on the event loop
+@router.get("/debug/profile")
+def debug_profile(seconds: float = Query(10, gt=0, le=MAX_SECONDS),
+                  format: str = Query('collapsed',
+                                      pattern='^(collapsed|svg)$'),
+                  idle: bool = False,
+                  x_profile_token: Optional[str] = Header(None)):
+    return profile_response(x_profile_token, seconds, format, idle)
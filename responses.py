@@ -0,0 +1,128 @@
+import hashlib
+import json
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+from fastapi import Response
+
+from metrics import timed
+
+
+class ResponseCache:
+    # Serialized bodies of catalog views and query results, keyed by
+    # whatever identifies the view (route, normalized query and catalog
+    # version, so a reload or insert never serves stale data). The bodies
+    # kept add up to at most `max_bytes`, evicted least recently used
+    # first, and expire after `ttl` seconds; bodies over `max_body` bytes
+    # are served but not kept. Concurrent misses on the same key are
+    # coalesced: the first caller builds the body and the rest wait for
+    # its result.
+    def __init__(self, max_bytes=64 << 20, max_body=1 << 20, ttl=300.0):
+        self.max_bytes = max_bytes
+        self.max_body = max_body
+        self.ttl = ttl
+        self.size = 0
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                body, etag, expires = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    return body, etag
+                self._remove(key)
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Future()
+
+        if not leader:
+            return flight.result()
+        try:
+            with timed('catalog'):
+                result = build()
+            with timed('encode'):
+                body = json.dumps(result, ensure_ascii=False,
+                                  separators=(',', ':')).encode()
+            etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        except BaseException as e:
+            flight.set_exception(e)
+            with self.lock:
+                del self.inflight[key]
+            raise
+        with self.lock:
+            if len(body) <= self.max_body:
+                if key in self.entries:
+                    self._remove(key)
+                self.entries[key] = body, etag, time.monotonic() + self.ttl
+                self.size += len(body)
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+            del self.inflight[key]
+        flight.set_result((body, etag))
+        return body, etag
+
+    def _remove(self, key):
+        # under self.lock
+        body, _, _ = self.entries.pop(key)
+        self.size -= len(body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+def cached_json(request, cache, key, build):
+    body, etag = cache.get(key, build)
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    return Response(body, media_type='application/json',
+                    headers={'ETag': etag})
+
+
+def ndjson_chunks(records, batch=256):
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, ensure_ascii=False,
+                                separators=(',', ':')))
+        if len(lines) == batch:
+            yield ('\n'.join(lines) + '\n').encode()
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def accepts_gzip(request):
+    encodings = request.headers.get('accept-encoding', '')
+    for encoding in encodings.split(','):
+        name, _, params = encoding.strip().partition(';')
+        if name.strip() == 'gzip' and params.replace(' ', '') != 'q=0':
+            return True
+    return False
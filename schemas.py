@@ -1,5 +1,12 @@
-from pydantic import BaseModel
-import json
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from loader import iter_records
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+BOOK_FIELDS = (
+    'title', 'isbn', 'pageCount', 'publishedDate', 'thumbnailUrl',
+    'shortDescription', 'longDescription', 'status', 'authors', 'categories',
+)
 
 
 class Books(BaseModel):
@@ -12,16 +19,72 @@ class Books(BaseModel):
     categories: list
 
 
-def read_data():
-    with open('books.json') as f:
-        json_data = json.loads(f.read())
+class IsbnBatch(BaseModel):
+    isbns: List[str] = Field(..., max_length=1000)
+
+
+# compiled once and reused for every line of a bulk upload
+book_adapter = TypeAdapter(Books)
+
+
+def validate_lines(lines, first_line):
+    # -> ([(line number, record)], [errors]) for a batch of NDJSON lines
+    books, errors = [], []
+    for n, line in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+        try:
+            book = book_adapter.validate_json(line)
+        except ValidationError as e:
+            errors.append({'line': n, 'errors': e.errors(include_url=False,
+                                                         include_input=False)})
+        else:
+            books.append((n, book.model_dump()))
+    return books, errors
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z'
+
+
+def parse_date(value):
+    # {"$date": "2009-04-01T00:00:00.000-0700"} -> (epoch ms, utc offset min)
+    if value is None:
+        return None
+    date = datetime.strptime(value['$date'], DATE_FORMAT)
+    millis = (date - EPOCH) // timedelta(milliseconds=1)
+    return millis, date.utcoffset() // timedelta(minutes=1)
+
+
+def date_millis(day, end=False):
+    # epoch ms at the start of a UTC day, or at its last millisecond
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    millis = (start - EPOCH) // timedelta(milliseconds=1)
+    return millis + 86400000 - 1 if end else millis
+
+
+def format_date(millis, offset):
+    tz = timezone(timedelta(minutes=offset))
+    date = (EPOCH + timedelta(milliseconds=millis)).astimezone(tz)
+    return {'$date': date.strftime('%Y-%m-%dT%H:%M:%S.')
+            + f'{date.microsecond // 1000:03d}' + date.strftime('%z')}
+
+
+def read_data(progress=None):
+    return list(iter_records('books.json', progress=progress))
+
 
-    return json_data
+def get_books_by_isbn(catalog, isbns):
+    books, missing = [], []
+    for isbn in dict.fromkeys(isbns):
+        book = catalog.get(isbn)
+        if book is not None:
+            books.append(book.to_dict())
+        else:
+            missing.append(isbn)
+    return {'message': books, 'missing': missing}
 
 
-def get_book_by_isbn(isbn):
-    for i in read_data():
-        if 'isbn' in i:
-            if i['isbn'] == isbn:
-                return isbn
-    return {f'No books with {isbn}'}
+def get_book_by_isbn(catalog, isbn):
+    book = catalog.get(isbn)
+    return book.to_dict() if book is not None else None
@@ -0,0 +1,282 @@
+import html
+import math
+import re
+from collections import defaultdict
+
+import numpy as np
+
+from postings import ROW, csr, find, gather, intersect
+
+TOKEN_RE = re.compile(r'\w+')
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+TEXT_FIELDS = ('title', 'shortDescription', 'longDescription')
+SNIPPET_FIELDS = ('shortDescription', 'longDescription', 'title')
+# positions are offset per field so a phrase never spans two fields
+FIELD_GAP = 1000000
+
+
+def tokenize(text):
+    return [match.group().casefold() for match in TOKEN_RE.finditer(text)]
+
+
+def parse_query(q):
+    # bare words are ANDed together, "quoted words" must appear as a phrase
+    terms, phrases = [], []
+    for phrase, word in QUERY_RE.findall(q):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) > 1:
+                phrases.append(tokens)
+            terms.extend(tokens)
+        elif word != 'AND':
+            terms.extend(tokenize(word))
+    return list(dict.fromkeys(terms)), phrases
+
+
+def normalize_query(q, fuzzy=False):
+    # queries that are bound to return the same results share one key
+    if fuzzy:
+        return tuple(sorted(set(tokenize(q))))
+    terms, phrases = parse_query(q)
+    return tuple(sorted(terms)), tuple(sorted(map(tuple, phrases)))
+
+
+class SearchIndex:
+    # Positional index over one segment's rows for BM25 search, fixed once
+    # built. Terms are sorted; each owns a slice of the postings (row, term
+    # frequency) in row order, and each posting a slice of `positions`.
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, records):
+        # term -> {row: [positions]}
+        postings = defaultdict(dict)
+        lengths = []
+        for row, record in enumerate(records):
+            length = 0
+            for n, field in enumerate(TEXT_FIELDS):
+                tokens = tokenize(getattr(record, field) or '')
+                for position, token in enumerate(tokens, n * FIELD_GAP):
+                    postings[token].setdefault(row, []).append(position)
+                length += len(tokens)
+            lengths.append(length)
+
+        self.terms = sorted(postings)
+        self.term_offsets, self.rows = csr(
+            [list(postings[term]) for term in self.terms])
+        self.position_offsets, self.positions = csr(
+            [positions for term in self.terms
+             for positions in postings[term].values()], dtype=np.int32)
+        self.tfs = np.diff(self.position_offsets).astype(np.int32)
+        self.lengths = np.array(lengths, dtype=np.int32)
+        self.total_length = int(self.lengths.sum())
+
+    def postings(self, term):
+        # -> (start, end) of the term's slice of the postings
+        n = find(self.terms, term)
+        if n < 0:
+            return 0, 0
+        return int(self.term_offsets[n]), int(self.term_offsets[n + 1])
+
+    def score(self, slices, idf, avg_length, phrases):
+        # slices: {term: postings slice} for every query term, idf: {term:
+        # idf over the whole catalog} -> (rows holding all terms and
+        # phrases, their BM25 scores)
+        lists = sorted((self.rows[start:end] for start, end in
+                        slices.values()), key=len)
+        rows = lists[0]
+        for other in lists[1:]:
+            rows = intersect(rows, other)
+        if phrases:
+            rows = np.array([row for row in rows.tolist()
+                             if all(self._has_phrase(row, phrase, slices)
+                                    for phrase in phrases)], dtype=ROW)
+
+        norm = self.k1 * (1 - self.b + self.b * self.lengths[rows] /
+                          avg_length)
+        scores = np.zeros(len(rows))
+        for term, (start, end) in slices.items():
+            tf = self.tfs[start + np.searchsorted(self.rows[start:end], rows)]
+            scores += idf[term] * tf * (self.k1 + 1) / (tf + norm)
+        return rows, scores
+
+    def _positions(self, row, slice_):
+        start, end = slice_
+        n = start + int(np.searchsorted(self.rows[start:end], row))
+        return self.positions[self.position_offsets[n]:
+                              self.position_offsets[n + 1]].tolist()
+
+    def _has_phrase(self, row, phrase, slices):
+        first = self._positions(row, slices[phrase[0]])
+        rest = [set(self._positions(row, slices[term])) for term in phrase[1:]]
+        return any(all(start + i in positions
+                       for i, positions in enumerate(rest, 1))
+                   for start in first)
+
+
+def search_all(indexes, q, k=10):
+    # indexes: [(first row, SearchIndex)] covering the catalog -> ([(row,
+    # score)], total). Document frequencies and lengths are summed over all
+    # of them, so scores don't depend on how the rows are split up.
+    terms, phrases = parse_query(q)
+    if not terms:
+        return [], 0
+    slices = [{term: index.postings(term) for term in terms}
+              for _, index in indexes]
+    docs = sum(len(index.lengths) for _, index in indexes)
+    idf = {}
+    for term in terms:
+        df = sum(found[term][1] - found[term][0] for found in slices)
+        if not df:
+            return [], 0
+        idf[term] = math.log(1 + (docs - df + 0.5) / (df + 0.5))
+    avg_length = sum(index.total_length for _, index in indexes) / docs or 1
+
+    rows, scores = [], []
+    for (first, index), found in zip(indexes, slices):
+        if any(start == end for start, end in found.values()):
+            continue
+        hits, hit_scores = index.score(found, idf, avg_length, phrases)
+        rows.append(hits.astype(np.int64) + first)
+        scores.append(hit_scores)
+    if not rows:
+        return [], 0
+    rows, scores = np.concatenate(rows), np.concatenate(scores)
+    top = np.lexsort((rows, -scores))[:k]
+    return [(int(rows[n]), float(scores[n])) for n in top], len(rows)
+
+
+def snippet(record, q, width=160):
+    terms, _ = parse_query(q)
+    wanted = set(terms)
+    for field in SNIPPET_FIELDS:
+        text = getattr(record, field) or ''
+        hits = [m for m in TOKEN_RE.finditer(text)
+                if m.group().casefold() in wanted]
+        if not hits:
+            continue
+        start = max(0, hits[0].start() - width // 4)
+        end = min(len(text), start + width)
+        parts, last = [], start
+        for m in hits:
+            if m.start() < start or m.end() > end:
+                continue
+            parts.append(html.escape(text[last:m.start()]))
+            parts.append('<mark>' + html.escape(m.group()) + '</mark>')
+            last = m.end()
+        parts.append(html.escape(text[last:end]))
+        prefix = '...' if start > 0 else ''
+        suffix = '...' if end < len(text) else ''
+        return prefix + ''.join(parts).strip() + suffix
+    return None
+
+
+def trigrams(word):
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_edits(word):
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 7:
+        return 1
+    return 2
+
+
+def bounded_levenshtein(a, b, bound):
+    # Edit distance between a and b counting an adjacent transposition as
+    # one edit, or None once it must exceed bound
+    if abs(len(a) - len(b)) > bound:
+        return None
+    before, previous = None, list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1,
+                       previous[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > bound:
+            return None
+        before, previous = previous, current
+    return previous[-1] if previous[-1] <= bound else None
+
+
+class TrigramIndex:
+    # Typo-tolerant lookup of one segment's title words. Each distinct word
+    # is indexed by its padded character trigrams; one edit touches at most
+    # four of them, so a word within k edits of the query shares at least
+    # len(trigrams) - 4k, which bounds the candidates that need a
+    # Levenshtein check.
+    def __init__(self, titles):
+        # title word -> rows whose title contains it
+        words = defaultdict(list)
+        for row, title in enumerate(titles):
+            for word in set(tokenize(title or '')):
+                words[word].append(row)
+        self.words = sorted(words)
+        self.word_offsets, self.word_rows = csr(
+            [words[word] for word in self.words])
+        # trigram -> ids of the words containing it
+        grams = defaultdict(list)
+        for n, word in enumerate(self.words):
+            for gram in trigrams(word):
+                grams[gram].append(n)
+        self.grams = sorted(grams)
+        self.gram_offsets, self.gram_words = csr(
+            [grams[gram] for gram in self.grams])
+
+    def rows(self, n):
+        return self.word_rows[self.word_offsets[n]:self.word_offsets[n + 1]]
+
+    def similar(self, word, distances):
+        # -> {word id: edits} for the words within max_edits(word) of word.
+        # `distances` caches edit distances by candidate across segments.
+        bound = max_edits(word)
+        if bound == 0:
+            n = find(self.words, word)
+            return {n: 0} if n >= 0 else {}
+        grams = trigrams(word)
+        ids = [n for n in (find(self.grams, gram) for gram in grams)
+               if n >= 0]
+        if not ids:
+            return {}
+        candidates, shared = np.unique(
+            gather(self.gram_offsets, self.gram_words, np.array(ids)),
+            return_counts=True)
+        need = len(grams) - 4 * bound
+        matches = {}
+        for n in candidates[shared >= need].tolist():
+            candidate = self.words[n]
+            if candidate not in distances:
+                distances[candidate] = bounded_levenshtein(
+                    word, candidate, bound)
+            if distances[candidate] is not None:
+                matches[n] = distances[candidate]
+        return matches
+
+
+def fuzzy_search_all(indexes, q, k=10):
+    # indexes: [(first row, TrigramIndex)] -> ([(row, edits)], total) for
+    # titles matching every query word
+    best = None
+    for word in dict.fromkeys(tokenize(q)):
+        edits, distances = {}, {}
+        for first, index in indexes:
+            for n, distance in index.similar(word, distances).items():
+                for row in (index.rows(n) + first).tolist():
+                    if distance < edits.get(row, distance + 1):
+                        edits[row] = distance
+        if best is None:
+            best = edits
+        else:
+            best = {row: best[row] + distance
+                    for row, distance in edits.items() if row in best}
+        if not best:
+            return [], 0
+    if best is None:
+        return [], 0
+    top = sorted(best, key=lambda row: (best[row], row))[:k]
+    return [(row, best[row]) for row in top], len(best)
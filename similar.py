@@ -0,0 +1,180 @@
+import hashlib
+import threading
+import time
+import traceback
+from collections import Counter
+
+import numpy as np
+
+from catalog import normalize
+from search import tokenize
+
+
+def document_terms(record):
+    terms = Counter(tokenize(record.shortDescription or ''))
+    terms.update(tokenize(record.longDescription or ''))
+    for category in record.categories or ():
+        terms['category:' + normalize(category)] += 1
+    return terms
+
+
+def document_key(record):
+    digest = hashlib.blake2b(digest_size=16)
+    for text in (record.shortDescription, record.longDescription):
+        digest.update((text or '').encode())
+        digest.update(b'\0')
+    for category in record.categories or ():
+        digest.update(category.encode())
+        digest.update(b'\0')
+    return digest.digest()
+
+
+def row_sums(values, indptr):
+    # per-row sums of a CSR matrix's values, 0 for empty rows
+    sums = np.concatenate(([0], np.cumsum(values, dtype=np.float64)))
+    return sums[indptr[1:]] - sums[indptr[:-1]]
+
+
+class TfidfIndex:
+    # L2-normalized TF-IDF rows for one catalog version in CSR form
+    # (indptr, indices, data). It keeps the ISBN and title of every book
+    # it covers, so it answers correctly for as long as it is served, even
+    # after the catalog it was built from has been replaced.
+    def __init__(self, version, books, documents):
+        # books: (isbn, title) of every row
+        self.version = version
+        self.rows = len(documents)
+        self.books = books
+        self.by_isbn = {}
+        for row, (isbn, _) in enumerate(self.books):
+            if isbn is not None:
+                self.by_isbn.setdefault(isbn, row)
+        self.vocabulary = {}
+        indptr = np.zeros(self.rows + 1, dtype=np.int64)
+        indices, counts = [], []
+        for row, terms in enumerate(documents):
+            for term, count in terms.items():
+                indices.append(
+                    self.vocabulary.setdefault(term, len(self.vocabulary)))
+                counts.append(count)
+            indptr[row + 1] = len(indices)
+
+        self.indptr = indptr
+        self.indices = np.array(indices, dtype=np.int32)
+        df = np.bincount(self.indices, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + self.rows) / (1 + df)) + 1
+        data = 1 + np.log(np.array(counts, dtype=np.float32))
+        data *= self.idf[self.indices]
+        lengths = np.diff(indptr)
+        norms = np.sqrt(row_sums(data ** 2, indptr))
+        data /= np.repeat(norms, lengths)
+        self.data = data.astype(np.float32)
+
+    def vector(self, terms):
+        # -> (indices, data) of the TF-IDF row for a book the index doesn't
+        # cover, leaving out terms it has never seen
+        ids, counts = [], []
+        for term, count in terms.items():
+            n = self.vocabulary.get(term)
+            if n is not None:
+                ids.append(n)
+                counts.append(count)
+        indices = np.array(ids, dtype=np.int32)
+        data = 1 + np.log(np.array(counts, dtype=np.float32))
+        data *= self.idf[indices]
+        norm = np.sqrt((data ** 2).sum())
+        return indices, data / norm if norm else data
+
+    def similar(self, row, record, k=10):
+        # -> [(row, score)] for the book at `row` of the current catalog,
+        # which is its row here too unless the catalog was reloaded since.
+        # Books inserted since the index was built are looked up by their
+        # own terms.
+        if row >= self.rows or self.books[row] != (record.isbn,
+                                                   record.title):
+            row = self.by_isbn.get(record.isbn) if record.isbn else None
+        if row is not None:
+            start, end = self.indptr[row], self.indptr[row + 1]
+            indices, data = self.indices[start:end], self.data[start:end]
+        else:
+            indices, data = self.vector(document_terms(record))
+        if not len(indices):
+            return []
+        query = np.zeros(len(self.vocabulary), dtype=np.float32)
+        query[indices] = data
+        # X @ q for a CSR matrix: per-row sums of data * q[indices]
+        scores = row_sums(self.data * query[self.indices], self.indptr)
+        if row is not None:
+            scores[row] = 0
+        k = min(k, len(scores) - (row is not None))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(other), float(scores[other]))
+                for other in top if scores[other] > 1e-9]
+
+
+class SimilarBooks:
+    # Serves the last TF-IDF index built and rebuilds it in a background
+    # thread when the catalog has moved on, at most once every
+    # `min_interval` seconds, so requests never wait for a build. Term
+    # counts are cached by a hash of each book's text, so a rebuild only
+    # tokenizes books whose descriptions changed.
+    def __init__(self, min_interval=10.0):
+        self.min_interval = min_interval
+        self.index = None
+        self.term_counts = {}
+        self.lock = threading.Lock()
+        self.building = False
+        self.started = None
+
+    def refresh(self, catalog):
+        with self.lock:
+            index = self.index
+            if self.building or (index is not None
+                                 and index.version == catalog.version):
+                return
+            if (self.started is not None
+                    and time.monotonic() - self.started < self.min_interval):
+                return
+            self.building = True
+            self.started = time.monotonic()
+        threading.Thread(target=self._build, args=(catalog,),
+                         name='similar-index', daemon=True).start()
+
+    def _build(self, catalog):
+        try:
+            books, term_counts, documents = [], {}, []
+            for record in catalog:
+                books.append((record.isbn, record.title))
+                key = document_key(record)
+                terms = self.term_counts.get(key)
+                if terms is None:
+                    terms = document_terms(record)
+                term_counts[key] = terms
+                documents.append(terms)
+            self.term_counts = term_counts
+            self.index = TfidfIndex(catalog.version, books, documents)
+        except Exception:
+            print("Building the similar books index failed")
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.building = False
+
+    def similar(self, catalog, row, k=10):
+        # -> results, or None until the first index is built
+        self.refresh(catalog)
+        index = self.index
+        if index is None:
+            return None
+        results = []
+        for other, score in index.similar(row, catalog.records[row], k):
+            isbn, title = index.books[other]
+            results.append({
+                'isbn': isbn,
+                'title': title,
+                'score': round(score, 4),
+            })
+        return results
@@ -0,0 +1,42 @@
+import json
+
+from wal import WriteAheadLog
+
+
+def write_lines(path, *lines):
+    with open(path, 'ab') as f:
+        f.write(b''.join(lines))
+
+
+def test_append_after_torn_tail(tmp_path):
+    path = str(tmp_path / 'books.wal')
+    write_lines(path, json.dumps({'title': 'A'}).encode() + b'\n',
+                b'{"title": "B", "isb')
+    wal = WriteAheadLog(path)
+    assert wal.read()[0] == [{'title': 'A'}]
+    with wal.exclusive():
+        wal.append([{'title': 'C'}])
+    wal.close()
+
+    records, position = WriteAheadLog(path).read()
+    assert records == [{'title': 'A'}, {'title': 'C'}]
+    assert position[1] == len(open(path, 'rb').read())
+
+
+def test_torn_tail_longer_than_a_read_chunk(tmp_path):
+    path = str(tmp_path / 'books.wal')
+    write_lines(path, b'{"title": "A"}\n', b'x' * 200000)
+    wal = WriteAheadLog(path)
+    with wal.exclusive():
+        wal.append([{'title': 'C'}])
+    wal.close()
+    assert wal.read()[0] == [{'title': 'A'}, {'title': 'C'}]
+
+
+def test_read_skips_unreadable_lines(tmp_path):
+    path = str(tmp_path / 'books.wal')
+    write_lines(path, b'{"title": "A"}\n', b'{"title": "B", "isb\n',
+                b'\xff\xfe\n', b'{"title": "C"}\n')
+    records, position = WriteAheadLog(path).read()
+    assert records == [{'title': 'A'}, {'title': 'C'}]
+    assert position[1] == len(open(path, 'rb').read())
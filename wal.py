@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+import traceback
+
+from locks import file_lock
+
+
+class WriteAheadLog:
+    # Append-only NDJSON log of inserted books. `append` only writes; the
+    # caller then waits in `wait_synced` until a background thread has
+    # fsynced its lines, so one fsync covers every append that arrived
+    # during the same interval. Wait after releasing any lock that other
+    # writers need, or they can't join the same fsync.
+    #
+    # Every worker process appends to the same file. Appends are made, and
+    # `truncate` runs, under an exclusive flock on `path + '.lock'`, taken
+    # with `exclusive`; callers hold it across their appends so they can
+    # check what other workers appended first. An append that finds the
+    # file replaced by another process's truncate reopens it, and cuts off
+    # a torn last line left by a crash so the next record isn't glued on.
+    def __init__(self, path, sync_interval=0.01):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.synced_cond = threading.Condition(self.lock)
+        self.written = 0
+        self.synced = 0
+        # position (see read) up to which the live catalog has applied
+        # this log
+        self.followed = None
+        self.f = open(path, 'ab')
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='wal-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sync()
+
+    def close(self):
+        self.stop()
+        self.f.close()
+
+    def exclusive(self):
+        # flock is per open file, so don't nest it in one process
+        return file_lock(self.lock_path)
+
+    def append(self, records):
+        # -> sequence number to pass to wait_synced. Call it inside
+        # exclusive().
+        lines = b''.join(
+            json.dumps(record, ensure_ascii=False).encode() + b'\n'
+            for record in records)
+        with self.lock:
+            self._reopen()
+            self._cut_torn_tail()
+            self.f.write(lines)
+            self.f.flush()
+            self.written += 1
+            if self._thread is None:
+                self._sync()
+            return self.written
+
+    def wait_synced(self, seq):
+        with self.lock:
+            while self.synced < seq:
+                self.synced_cond.wait()
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.synced == self.written:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.synced = self.written
+        self.synced_cond.notify_all()
+
+    def _reopen(self):
+        # under self.lock: reopen the log if another process replaced it
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(
+                self.f.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            # what was written here was copied into the new file
+            self._sync()
+            self.f.close()
+            self.f = open(self.path, 'ab')
+
+    def _cut_torn_tail(self):
+        # under self.lock and exclusive(): truncate the log after its last
+        # complete line. A line without its newline was never synced, so
+        # its insert was never acknowledged.
+        size = os.fstat(self.f.fileno()).st_size
+        end = size
+        with open(self.path, 'rb') as f:
+            if end:
+                f.seek(end - 1)
+                if f.read(1) == b'\n':
+                    return
+            while end:
+                start = max(end - (1 << 16), 0)
+                f.seek(start)
+                n = f.read(end - start).rfind(b'\n')
+                if n >= 0:
+                    end = start + n + 1
+                    break
+                end = start
+        if end < size:
+            print(f"Dropping a torn line of {size - end} bytes at the end "
+                  f"of {self.path}")
+            os.ftruncate(self.f.fileno(), end)
+
+    def read(self, position=None):
+        # -> (records in complete lines after position, position to read
+        # from next time). A position is (inode, offset), None for the
+        # start; a log trimmed since by a compaction is read again from
+        # its start.
+        records = []
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return records, None
+        with f:
+            inode, offset = position or (None, 0)
+            stat = os.fstat(f.fileno())
+            if inode != stat.st_ino or offset > stat.st_size:
+                offset = 0
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # torn write from a crash, or a line still being written
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"Skipping an unreadable line at offset {offset} "
+                          f"of {self.path}")
+                offset += len(line)
+        return records, (stat.st_ino, offset)
+
+    def size(self):
+        # of the shared file, whichever process appended to it
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def truncate(self, position):
+        # Drop everything before `position`, from read(), keeping anything
+        # appended after it. Call it under the lock that guards `followed`.
+        inode, offset = position
+        tmp = self.path + '.tmp'
+        with self.exclusive(), self.lock:
+            self._sync()
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_ino != inode:
+                    raise RuntimeError(f'{self.path} was replaced since '
+                                       f'it was read')
+                f.seek(offset)
+                rest = f.read()
+            with open(tmp, 'wb') as f:
+                f.write(rest)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.f.close()
+            self.f = open(self.path, 'ab')
+            if self.followed is not None and self.followed[0] == inode:
+                self.followed = (os.fstat(self.f.fileno()).st_ino,
+                                 max(self.followed[1] - offset, 0))
+
+
+def write_catalog(path, records):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('[')
+        separator = '\n'
+        for record in records:
+            f.write(separator)
+            f.write(json.dumps(record, indent=2, ensure_ascii=False))
+            separator = ',\n'
+        f.write('\n]\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Compactor:
+    # Periodically folds the log back into the catalog file once it has
+    # grown past `min_bytes`. Every worker runs one; an exclusive flock on
+    # `log.path + '.compact'` lets one at a time in and the others skip.
+    def __init__(self, log, compact, interval=60.0, min_bytes=1 << 20):
+        self.log = log
+        self.compact = compact
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='wal-compactor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.log.size() < self.min_bytes:
+                continue
+            with file_lock(self.log.path + '.compact', wait=False) as locked:
+                if not locked:
+                    continue
+                try:
+                    self.compact()
+                except Exception:
+                    print("Catalog compaction failed")
+                    traceback.print_exc()
@@ -0,0 +1,107 @@
+import os
+import threading
+import traceback
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class CatalogWatcher:
+    # Polls the catalog files and rebuilds the catalog in a background
+    # thread when they change. Readers take `watcher.catalog` once per
+    # request; a finished catalog replaces it in a single assignment so
+    # nobody ever sees a half-built index.
+    #
+    # `prepare` is given what `load` returned while holding `lock` and
+    # returns the catalog to swap in; writers hold the same lock so nothing
+    # they add to the old catalog can be missed by the new one. `follow`,
+    # if given, is called with the live catalog under the lock every poll
+    # and returns the catalog that replaces it.
+    def __init__(self, paths, load, interval=2.0, prepare=None, follow=None):
+        self.paths = paths
+        self.load = load
+        self.interval = interval
+        self.prepare = prepare
+        self.follow = follow
+        self.lock = threading.Lock()
+        self.loaded = self.seen = None
+        self.catalog = None
+        self.ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _prepare(self, catalog):
+        if self.prepare is not None:
+            catalog = self.prepare(catalog)
+        return catalog
+
+    def stamp(self):
+        return tuple(file_stamp(path) for path in self.paths)
+
+    def start(self):
+        # The first load runs on the watcher thread rather than at import,
+        # so processes that import the app without serving it (the parent
+        # of several workers, for one) never parse the catalog, and the
+        # server can answer readiness probes while it loads. `ready` is set
+        # once a catalog is live.
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='catalog-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        if self.catalog is None:
+            self.loaded = self.seen = self.stamp()
+            try:
+                catalog = self.load()
+                with self.lock:
+                    self.catalog = self._prepare(catalog)
+            except Exception:
+                # loaded keeps this stamp, so check() tries again once the
+                # files change rather than on every poll
+                print("Catalog load failed, retrying on the next change")
+                traceback.print_exc()
+            else:
+                self.ready.set()
+        while not self._stop.wait(self.interval):
+            self.check()
+            if self.follow is not None and self.catalog is not None:
+                try:
+                    with self.lock:
+                        self.catalog = self.follow(self.catalog)
+                except Exception:
+                    traceback.print_exc()
+
+    def check(self):
+        stamp = self.stamp()
+        if stamp != self.seen:
+            # still being written, wait until it has been quiet for a poll
+            self.seen = stamp
+            return False
+        if stamp == self.loaded:
+            return False
+        # a failed load is not retried until the files change again
+        self.loaded = stamp
+        try:
+            catalog = self.load()
+            with self.lock:
+                self.catalog = self._prepare(catalog)
+        except Exception:
+            print("Catalog reload failed, keeping the current catalog until "
+                  "the next change")
+            traceback.print_exc()
+            return False
+        self.ready.set()
+        print(f"Reloaded catalog with {len(self.catalog)} books")
+        return True